@@ -1,9 +1,15 @@
 import streamlit as st
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import timedelta
+from pathlib import Path
+import hashlib
+import os
+import tempfile
 import numpy as np
+from numba import njit
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -69,46 +75,290 @@ def generate_mock_data():
     products = ['Wireless Headphones', 'Gaming Mouse', 'Mechanical Keyboard', '4K Monitor', 'Laptop Stand']
     prices = {'Wireless Headphones': 120, 'Gaming Mouse': 60, 'Mechanical Keyboard': 150, '4K Monitor': 350, 'Laptop Stand': 45}
     
-    data = []
-    for date in selected_dates:
-        prod = np.random.choice(products)
-        qty = np.random.randint(1, 4)
-        data.append({
-            'OrderDate': date,
-            'CustomerID': f"CUST-{np.random.randint(1000, 1050)}",
-            'ProductID': prod,
-            'Quantity': qty,
-            'TotalSales': prices[prod] * qty
-        })
-    return pd.DataFrame(data)
+    # Vectorized row generation: one numpy call per column instead of per order
+    n = len(selected_dates)
+    prod_idx = np.random.randint(0, len(products), n)
+    qty = np.random.randint(1, 4, n)
+    unit_prices = np.array([prices[p] for p in products])[prod_idx]
+    customers = np.char.add('CUST-', np.random.randint(1000, 1050, n).astype(str))
+    return pd.DataFrame({
+        'OrderDate': selected_dates,
+        'CustomerID': customers,
+        'ProductID': np.array(products)[prod_idx],
+        'Quantity': qty,
+        'TotalSales': unit_prices * qty
+    })
 
 # --- HELPER: CLEAN DATA ---
+@st.cache_data
 def clean_data(df):
     df = df.drop_duplicates()
     if 'OrderDate' in df.columns:
-        df['OrderDate'] = pd.to_datetime(df['OrderDate'], dayfirst=True, errors='coerce')
+        # ISO dates first so 'mixed' + dayfirst can't swap day/month on them (2023-02-03 -> 2023-03-02);
+        # only the rows that aren't ISO (e.g. 15-01-2023) fall through to the day-first parser
+        order_dates = pd.to_datetime(df['OrderDate'], format='ISO8601', errors='coerce')
+        non_iso = order_dates.isna()
+        if non_iso.any():
+            order_dates[non_iso] = pd.to_datetime(df.loc[non_iso, 'OrderDate'], format='mixed', dayfirst=True, errors='coerce')
+        df['OrderDate'] = order_dates
     
     numeric_cols = ['TotalSales', 'Quantity']
     for col in numeric_cols:
         if col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.replace(r'[$,]', '', regex=True)
+            # Object or Arrow-backed strings (e.g. "$1,200.00")
+            if pd.api.types.is_string_dtype(df[col]):
+                df[col] = df[col].str.replace('$', '', regex=False).str.replace(',', '', regex=False)
             df[col] = pd.to_numeric(df[col], errors='coerce')
             
     df = df.dropna(subset=['OrderDate', 'TotalSales'])
+
+    # Low-cardinality IDs: categorical codes make groupby/nunique hash ints, not strings
+    for col in ('ProductID', 'CustomerID'):
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    # Narrow Quantity to the smallest integer type; TotalSales stays 64-bit so sums don't
+    # pick up float32 rounding and the numpy consumers read it without a widening copy
+    if 'Quantity' in df.columns:
+        df['Quantity'] = pd.to_numeric(df['Quantity'], downcast='integer')
+
+    # Sorted dates let the date-range filter slice with searchsorted
+    df = df.sort_values('OrderDate', kind='stable').reset_index(drop=True)
     return df
 
 # --- HELPER: LOAD DATA ---
-@st.cache_data
+# Cleaned uploads are persisted as Parquet, keyed by file content, so repeat loads skip CSV parsing.
+# Bump PARQUET_CACHE_VERSION whenever clean_data's output changes so older copies are ignored.
+PARQUET_CACHE_VERSION = 3
+PARQUET_CACHE_DIR = Path(os.environ.get("ECOMMERCE_ANALYTICS_CACHE_DIR", Path.home() / ".cache" / "ecommerce-analytics"))
+PARQUET_CACHE_MAX_FILES = 20  # least recently used copies beyond this are deleted
+# Matches only this app's copies (any version): v<N>-<32-hex md5>.parquet
+PARQUET_CACHE_GLOB = "v*-" + "[0-9a-f]" * 32 + ".parquet"
+
+def read_parquet_cache(path):
+    if not path.exists():
+        return None
+    try:
+        df = pd.read_parquet(path, engine='pyarrow')
+    except OSError:
+        return None  # unreadable right now (permissions, I/O): just re-parse the CSV
+    except ValueError:
+        # Partial or corrupt copy (pyarrow.ArrowInvalid): drop it and re-parse the CSV
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(path)  # best effort: mark as recently used for eviction
+    except OSError:
+        pass
+    return df
+
+def write_parquet_cache(path, df):
+    tmp_path = None
+    try:
+        PARQUET_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=PARQUET_CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp_path, engine='pyarrow', compression='zstd', index=False)
+        os.replace(tmp_path, path)  # atomic: readers never see a half-written file
+        tmp_path = None
+
+        # Eviction covers copies from older cache versions too, but never other Parquet files
+        current = f"v{PARQUET_CACHE_VERSION}-"
+        cached = sorted(PARQUET_CACHE_DIR.glob(PARQUET_CACHE_GLOB), key=lambda p: p.stat().st_mtime, reverse=True)
+        for stale in cached[PARQUET_CACHE_MAX_FILES:] + [p for p in cached if not p.name.startswith(current)]:
+            stale.unlink(missing_ok=True)
+    except Exception:
+        pass  # e.g. read-only filesystem: the shadow copy is only an optimization
+    finally:
+        if tmp_path is not None:
+            Path(tmp_path).unlink(missing_ok=True)
+
+# Key uploads on their per-upload file_id instead of hashing the whole file each rerun;
+# re-uploading identical bytes misses this cache but still hits the Parquet copy
+@st.cache_data(hash_funcs={UploadedFile: lambda f: f.file_id})
 def load_data(file):
     try:
-        df = pd.read_csv(file)
+        digest = hashlib.md5(file.getbuffer()).hexdigest()
+        cache_path = PARQUET_CACHE_DIR / f"v{PARQUET_CACHE_VERSION}-{digest}.parquet"
+        df = read_parquet_cache(cache_path)
+        if df is not None:
+            return df
+
+        df = pd.read_csv(file, engine='pyarrow', dtype_backend='pyarrow')
         df = clean_data(df) 
+        write_parquet_cache(cache_path, df)
         return df
     except Exception as e:
         st.error(f"Error loading file: {e}")
         return None
 
+# --- HELPER: WEEKLY REVENUE ---
+def weekly_sales(df):
+    # Equivalent to resample('W') (weeks ending Sunday) without the set_index copy
+    days = df['OrderDate'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    week_end = days + (6 - (days + 3) % 7)  # 1970-01-01 was a Thursday
+    if week_end.size == 0:
+        return pd.DataFrame({'OrderDate': pd.to_datetime([]), 'TotalSales': []})
+    first = week_end.min()
+    codes = (week_end - first) // 7
+    totals = np.bincount(codes, weights=df['TotalSales'].to_numpy(dtype=float))
+    return pd.DataFrame({
+        'OrderDate': (first + 7 * np.arange(totals.size)).astype('datetime64[D]').astype('datetime64[ns]'),
+        'TotalSales': totals
+    })
+
+# --- HELPER: TOP PRODUCTS ---
+def top_products_by_sales(df, n):
+    # Single bincount pass over the ProductID category codes; -1 codes (missing IDs) are skipped
+    codes = df['ProductID'].cat.codes.to_numpy()
+    sales = df['TotalSales'].to_numpy(dtype=float)
+    valid = codes >= 0
+    n_categories = len(df['ProductID'].cat.categories)
+    sums = np.bincount(codes[valid], weights=sales[valid], minlength=n_categories)
+    observed = np.flatnonzero(np.bincount(codes[valid], minlength=n_categories))
+    if observed.size > n:
+        observed = np.sort(observed[np.argpartition(-sums[observed], n - 1)[:n]])
+    top = observed[np.argsort(-sums[observed], kind='stable')]
+    return pd.DataFrame({
+        'ProductID': df['ProductID'].cat.categories[top],
+        'TotalSales': sums[top]
+    })
+
+# --- HELPER: FILTER BY DATE RANGE ---
+def filter_by_date(df, start_date, end_date):
+    # Requires df sorted by OrderDate (see clean_data); O(log N) bounds + contiguous slice
+    dates = df['OrderDate'].to_numpy()
+    lo = np.searchsorted(dates, pd.Timestamp(start_date).to_datetime64().astype(dates.dtype))
+    hi = np.searchsorted(dates, pd.Timestamp(end_date).to_datetime64().astype(dates.dtype), side='right')
+    return df.iloc[lo:hi]
+
+# --- HELPER: RFM SEGMENTATION ---
+CHAMPION_SCORES = np.array([444, 434, 443, 344], dtype=np.int16)
+
+def quartile_score(values, reverse=False):
+    # Same right-closed quartile bins as pd.qcut(values, 4), scored 1-4 (4-1 if reversed)
+    a = np.asarray(values, dtype=float)
+    edges = np.quantile(a, [0.25, 0.5, 0.75])
+    score = np.searchsorted(edges, a) + 1
+    return (5 - score if reverse else score).astype(np.int8)
+
+@njit(cache=True)
+def rfm_kernel(codes, dates_i8, sales, n):
+    last_order = np.full(n, np.iinfo(np.int64).min, np.int64)
+    frequency = np.zeros(n, np.int64)
+    monetary = np.zeros(n, np.float64)
+    for i in range(codes.size):
+        c = codes[i]
+        if c < 0:  # missing CustomerID
+            continue
+        if dates_i8[i] > last_order[c]:
+            last_order[c] = dates_i8[i]
+        frequency[c] += 1
+        monetary[c] += sales[i]
+    return last_order, frequency, monetary
+
+@st.cache_data
+def compute_rfm(df, snapshot_date):
+    # Fused single-pass reduction over the CustomerID category codes (sorted like groupby keys)
+    codes = df['CustomerID'].cat.codes.to_numpy()
+    dates = df['OrderDate'].to_numpy()
+    n_customers = len(df['CustomerID'].cat.categories)
+    last_order, frequency, monetary = rfm_kernel(
+        codes, dates.view(np.int64), df['TotalSales'].to_numpy(dtype=np.float64), n_customers
+    )
+    observed = np.flatnonzero(frequency)
+    rfm = pd.DataFrame({
+        'Recency': (snapshot_date - pd.DatetimeIndex(last_order[observed].view(dates.dtype))).days,
+        'Frequency': frequency[observed],
+        'Monetary': monetary[observed]
+    }, index=pd.Index(df['CustomerID'].cat.categories[observed], name='CustomerID'))
+
+    rfm['R_Score'] = quartile_score(rfm['Recency'], reverse=True)
+    rfm['F_Score'] = quartile_score(rfm['Frequency'].rank(method='first'))
+    rfm['M_Score'] = quartile_score(rfm['Monetary'])
+
+    # Integer RFM code (e.g. 4, 3, 4 -> 434); widen to int16 so R * 100 can't overflow int8
+    r = rfm['R_Score'].to_numpy()
+    score = r.astype(np.int16) * 100 + rfm['F_Score'].to_numpy() * 10 + rfm['M_Score'].to_numpy()
+    rfm['RFM_Score'] = score
+
+    # Vectorized segmentation (first matching condition wins)
+    conds = [np.isin(score, CHAMPION_SCORES), r == 4, r == 1]
+    choices = ['Champions', 'New Users', 'At Risk']
+    rfm['Segment'] = np.select(conds, choices, default='Regular')
+    return rfm
+
+# --- HELPER: CHART BUILDERS ---
+# Each builder takes a small, pre-aggregated frame so the cache key is cheap to hash
+@st.cache_data
+def make_trend_fig(sales_over_time):
+    # Area Chart matching the screenshot style
+    fig_trend = px.area(sales_over_time, x='OrderDate', y='TotalSales', 
+                        title=None,
+                        color_discrete_sequence=['#4e73df']) # Blue color
+
+    # FORCE DARK TEMPLATE
+    fig_trend.update_layout(
+        xaxis_title="", 
+        yaxis_title="Sales ($)", 
+        template="plotly_dark",  # <-- Key change for dark mode
+        margin=dict(l=0, r=0, t=10, b=0),
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+    )
+    return fig_trend
+
+@st.cache_data
+def make_top_products_fig(top_products):
+    # Bar Chart matching the screenshot style
+    fig_bar = px.bar(top_products, x='ProductID', y='TotalSales', 
+                     color='TotalSales', 
+                     color_continuous_scale='Blues') # Blue gradient
+
+    # FORCE DARK TEMPLATE
+    fig_bar.update_layout(
+        xaxis_title=None, 
+        yaxis_title=None, 
+        showlegend=False, 
+        template="plotly_dark", # <-- Key change for dark mode
+        margin=dict(l=0, r=0, t=10, b=0),
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+    )
+    return fig_bar
+
+@st.cache_data
+def make_segment_pie_fig(segment_counts):
+    fig_pie = px.pie(values=segment_counts.values, names=segment_counts.index, 
+                       hole=0.5, color_discrete_sequence=px.colors.qualitative.Pastel)
+    fig_pie.update_layout(showlegend=True, margin=dict(l=0, r=0, t=0, b=0), template="plotly_dark", paper_bgcolor='rgba(0,0,0,0)')
+    return fig_pie
+
+BUBBLE_MAX_POINTS = 2000
+
+def sample_per_segment(rfm, max_points=BUBBLE_MAX_POINTS):
+    # Stratified cap: keep up to max_points // n_segments random customers per Segment
+    if len(rfm) <= max_points:
+        return rfm
+    per_segment = max(1, max_points // rfm['Segment'].nunique())
+    shuffled = rfm.sample(frac=1, random_state=0)
+    return shuffled[shuffled.groupby('Segment').cumcount() < per_segment]
+
+@st.cache_data
+def make_rfm_bubble_fig(rfm):
+    fig_bubble = px.scatter(rfm, x='Frequency', y='Monetary', 
+                            color='Segment', size='Monetary', 
+                            hover_name=rfm.index,
+                            color_discrete_sequence=px.colors.qualitative.Pastel)
+    fig_bubble.update_layout(template="plotly_dark", xaxis_title="Order Frequency", yaxis_title="Total Spend", paper_bgcolor='rgba(0,0,0,0)')
+    return fig_bubble
+
+# --- RAW DATA PREVIEW ---
+RAW_PREVIEW_ROWS = 1000
+
 # --- SIDEBAR CONFIGURATION ---
 with st.sidebar:
     st.title("Data Controls")
@@ -167,8 +417,7 @@ if df is not None:
             # Handle user input (they might pick 1 date or 2)
             if len(date_range) == 2:
                 start_date, end_date = date_range
-                mask = (df_year['OrderDate'] >= pd.to_datetime(start_date)) & (df_year['OrderDate'] <= pd.to_datetime(end_date))
-                filtered_df = df_year.loc[mask]
+                filtered_df = filter_by_date(df_year, start_date, end_date)
             else:
                 start_date, end_date = date_range[0], date_range[0]
                 filtered_df = df_year
@@ -185,9 +434,11 @@ if df is not None:
 
     # --- TAB 1: EXECUTIVE OVERVIEW ---
     with tab1:
-        total_revenue = filtered_df['TotalSales'].sum()
-        avg_order_value = filtered_df['TotalSales'].mean()
-        total_orders = len(filtered_df)
+        sales_kpis = filtered_df['TotalSales'].agg(['sum', 'mean', 'count'])
+        total_revenue = sales_kpis['sum']
+        avg_order_value = sales_kpis['mean']
+        total_orders = int(sales_kpis['count'])
+        # Categorical CustomerID: nunique counts the observed codes, not the full category list
         unique_customers = filtered_df['CustomerID'].nunique()
         
         c1, c2, c3, c4 = st.columns(4)
@@ -202,90 +453,35 @@ if df is not None:
         
         with col_left:
             st.subheader("Revenue Trend")
-            sales_over_time = filtered_df.set_index('OrderDate').resample('W')['TotalSales'].sum().reset_index()
-            
-            # Area Chart matching the screenshot style
-            fig_trend = px.area(sales_over_time, x='OrderDate', y='TotalSales', 
-                                title=None,
-                                color_discrete_sequence=['#4e73df']) # Blue color
+            sales_over_time = weekly_sales(filtered_df)
             
-            # FORCE DARK TEMPLATE
-            fig_trend.update_layout(
-                xaxis_title="", 
-                yaxis_title="Sales ($)", 
-                template="plotly_dark",  # <-- Key change for dark mode
-                margin=dict(l=0, r=0, t=10, b=0),
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)'
-            )
+            fig_trend = make_trend_fig(sales_over_time)
             st.plotly_chart(fig_trend, use_container_width=True)
 
         with col_right:
             st.subheader("Top Products")
-            top_products = filtered_df.groupby('ProductID')['TotalSales'].sum().nlargest(5).reset_index()
+            top_products = top_products_by_sales(filtered_df, 5)
             
-            # Bar Chart matching the screenshot style
-            fig_bar = px.bar(top_products, x='ProductID', y='TotalSales', 
-                             color='TotalSales', 
-                             color_continuous_scale='Blues') # Blue gradient
-            
-            # FORCE DARK TEMPLATE
-            fig_bar.update_layout(
-                xaxis_title=None, 
-                yaxis_title=None, 
-                showlegend=False, 
-                template="plotly_dark", # <-- Key change for dark mode
-                margin=dict(l=0, r=0, t=10, b=0),
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)'
-            )
+            fig_bar = make_top_products_fig(top_products)
             st.plotly_chart(fig_bar, use_container_width=True)
 
     # --- TAB 2: RFM SEGMENTATION ---
     with tab2:
         if not filtered_df.empty:
             snapshot_date = filtered_df['OrderDate'].max() + timedelta(days=1)
-            rfm = filtered_df.groupby('CustomerID').agg({
-                'OrderDate': lambda x: (snapshot_date - x.max()).days,
-                'CustomerID': 'count',
-                'TotalSales': 'sum'
-            }).rename(columns={'OrderDate': 'Recency', 'CustomerID': 'Frequency', 'TotalSales': 'Monetary'})
-
-            rfm['R_Score'] = pd.qcut(rfm['Recency'], 4, labels=['4','3','2','1'])
-            try:
-                rfm['F_Score'] = pd.qcut(rfm['Frequency'].rank(method='first'), 4, labels=['1','2','3','4'])
-                rfm['M_Score'] = pd.qcut(rfm['Monetary'], 4, labels=['1','2','3','4'])
-            except:
-                rfm['F_Score'] = '1'
-                rfm['M_Score'] = '1'
-
-            rfm['RFM_Score'] = rfm['R_Score'].astype(str) + rfm['F_Score'].astype(str) + rfm['M_Score'].astype(str)
-
-            def segment_customer(row):
-                if row['RFM_Score'] in ['444', '434', '443', '344']: return 'Champions'
-                elif row['R_Score'] == '4': return 'New Users'
-                elif row['R_Score'] == '1': return 'At Risk'
-                else: return 'Regular'
-
-            rfm['Segment'] = rfm.apply(segment_customer, axis=1)
+            rfm = compute_rfm(filtered_df, snapshot_date)
 
             r_col1, r_col2 = st.columns([1, 2])
             
             with r_col1:
                 st.markdown("#### Distribution")
                 segment_counts = rfm['Segment'].value_counts()
-                fig_pie = px.pie(values=segment_counts.values, names=segment_counts.index, 
-                                   hole=0.5, color_discrete_sequence=px.colors.qualitative.Pastel)
-                fig_pie.update_layout(showlegend=True, margin=dict(l=0, r=0, t=0, b=0), template="plotly_dark", paper_bgcolor='rgba(0,0,0,0)')
+                fig_pie = make_segment_pie_fig(segment_counts)
                 st.plotly_chart(fig_pie, use_container_width=True)
 
             with r_col2:
                 st.markdown("#### Value vs Frequency Matrix")
-                fig_bubble = px.scatter(rfm, x='Frequency', y='Monetary', 
-                                        color='Segment', size='Monetary', 
-                                        hover_name=rfm.index,
-                                        color_discrete_sequence=px.colors.qualitative.Pastel)
-                fig_bubble.update_layout(template="plotly_dark", xaxis_title="Order Frequency", yaxis_title="Total Spend", paper_bgcolor='rgba(0,0,0,0)')
+                fig_bubble = make_rfm_bubble_fig(sample_per_segment(rfm[['Frequency', 'Monetary', 'Segment']]))
                 st.plotly_chart(fig_bubble, use_container_width=True)
                 
             with st.expander("View Customer Details"):
@@ -301,7 +497,8 @@ if df is not None:
 
     # --- TAB 3: DATA ---
     with tab3:
-        st.dataframe(filtered_df, use_container_width=True)
+        st.caption(f"Showing the first {min(len(filtered_df), RAW_PREVIEW_ROWS):,} of {len(filtered_df):,} rows")
+        st.dataframe(filtered_df.head(RAW_PREVIEW_ROWS), use_container_width=True)
 
 else:
     st.container()